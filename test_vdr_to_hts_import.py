@@ -21,7 +21,22 @@ import pytest
 from requests.auth import HTTPDigestAuth
 
 import vdr_to_hts_import
-from vdr_to_hts_import import Config, DirWalker, Importer, Info, InfoError, UnicodeEscapeHeuristic
+from vdr_to_hts_import import (Config, DirWalker, Importer, Info, InfoError, Quarantine, Recording, Scheduler,
+                               TsScanner, UnicodeEscapeHeuristic)
+
+
+def ts_packet(pid, counter, payload=True, discontinuity=False):
+    adaptation_field_control = 0x1 if payload else 0x2
+    packet = bytearray(188)
+    packet[0] = 0x47
+    packet[1] = pid >> 8
+    packet[2] = pid & 0xff
+    packet[3] = adaptation_field_control << 4 | counter
+    if discontinuity:
+        packet[3] |= 0x20
+        packet[4] = 1
+        packet[5] = 0x80
+    return bytes(packet)
 
 
 def test_dir_walker_walk(mocker):
@@ -30,6 +45,7 @@ def test_dir_walker_walk(mocker):
     file_list = ['file1', 'file2.ts', 'info']
     mocker.patch('os.walk', return_value=[['root1', [], file_list]])
     importer_mock = mocker.patch('vdr_to_hts_import.Importer')
+    mocker.patch('vdr_to_hts_import.Quarantine')
 
     walker = DirWalker('user')
     walker.walk('top')
@@ -41,6 +57,327 @@ def test_dir_walker_walk(mocker):
     ])
 
 
+def test_dir_walker_walk_resumes_checkpoint(mocker, tmp_path):
+    top = tmp_path.resolve() / 'videos'
+    for name in ['done', 'left', 'new']:
+        (top / 'title1' / name).mkdir(parents=True)
+        (top / 'title1' / name / 'info').write_text('T title1\n')
+    checkpoint_path = tmp_path / 'checkpoint'
+    checkpoint_path.write_text(json.dumps({
+        'top_directory': str(top),
+        'known': [str(top / 'title1' / 'done'), str(top / 'title1' / 'left')],
+        'remaining': [str(top / 'title1' / 'left')],
+        'failed': []
+    }))
+    importer_mock = mocker.patch('vdr_to_hts_import.Importer')
+    mocker.patch('vdr_to_hts_import.Quarantine')
+
+    walker = DirWalker('user', scheduler=Scheduler(checkpoint_path=checkpoint_path))
+    walker.walk(top)
+
+    imported = {call.args[0].name for call in importer_mock.return_value.import_record.call_args_list}
+    assert {'left', 'new'} == imported
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert {str(top / 'title1' / name) for name in ['done', 'left', 'new']} == set(checkpoint['known'])
+    assert [] == checkpoint['remaining']
+
+    importer_mock.return_value.import_record.reset_mock()
+    walker.walk(top)
+
+    importer_mock.return_value.import_record.assert_not_called()
+
+
+def test_dir_walker_walk_relative_top_directory(mocker, monkeypatch, tmp_path):
+    (tmp_path / 'videos' / 'title1' / 'date1').mkdir(parents=True)
+    (tmp_path / 'videos' / 'title1' / 'date1' / 'info').write_text('T title1\n')
+    (tmp_path / 'other').mkdir()
+    checkpoint_path = tmp_path / 'checkpoint'
+    importer_mock = mocker.patch('vdr_to_hts_import.Importer')
+    mocker.patch('vdr_to_hts_import.Quarantine')
+    walker = DirWalker('user', scheduler=Scheduler(checkpoint_path=checkpoint_path))
+
+    monkeypatch.chdir(tmp_path)
+    walker.walk('videos')
+    monkeypatch.chdir(tmp_path / 'other')
+    walker.walk('../videos')
+
+    importer_mock.return_value.import_record.assert_called_once()
+
+
+def test_dir_walker_walk_ignores_checkpoint_of_other_directory(mocker, tmp_path):
+    top = tmp_path / 'videos'
+    (top / 'title1' / 'date1').mkdir(parents=True)
+    (top / 'title1' / 'date1' / 'info').write_text('T title1\n')
+    checkpoint_path = tmp_path / 'checkpoint'
+    checkpoint_path.write_text(json.dumps({
+        'top_directory': str(tmp_path / 'other'),
+        'known': [str(top / 'title1' / 'date1')],
+        'remaining': [],
+        'failed': []
+    }))
+    importer_mock = mocker.patch('vdr_to_hts_import.Importer')
+    mocker.patch('vdr_to_hts_import.Quarantine')
+
+    walker = DirWalker('user', scheduler=Scheduler(checkpoint_path=checkpoint_path))
+    walker.walk(top)
+
+    importer_mock.return_value.import_record.assert_called_once_with(top / 'title1' / 'date1', ['info'])
+
+
+def test_dir_walker_walk_skips_quarantined(mocker):
+    mocker.patch('pathlib.Path.iterdir', return_value=[Path('dir1')])
+    mocker.patch('pathlib.Path.is_dir', return_value=True)
+    mocker.patch('os.walk', return_value=[['root1', [], ['file1.ts', 'info']]])
+    importer_mock = mocker.patch('vdr_to_hts_import.Importer')
+    quarantine_mock = mocker.patch('vdr_to_hts_import.Quarantine')
+    quarantine_mock.return_value.check.return_value = False
+
+    walker = DirWalker('user', 'quarantine')
+    walker.walk('top')
+
+    quarantine_mock.assert_called_once_with('quarantine')
+    importer_mock.return_value.import_record.assert_not_called()
+
+
+def test_quarantine_check_intact(tmp_path):
+    (tmp_path / '00001.ts').write_bytes(ts_packet(0x100, 0) + ts_packet(0x100, 1))
+    (tmp_path / '00002.ts').write_bytes(ts_packet(0x100, 2))
+
+    assert Quarantine('quarantine').check(tmp_path, ['00001.ts', '00002.ts', 'info'])
+    assert not (tmp_path / Quarantine.REPORT_FILENAME).exists()
+
+
+def test_quarantine_check_corrupt_writes_report(tmp_path):
+    (tmp_path / '00001.ts').write_bytes(ts_packet(0x100, 0) + b'\x00' * 100)
+
+    assert not Quarantine().check(tmp_path, ['00001.ts', 'info'])
+    assert '100 trailing bytes' in (tmp_path / Quarantine.REPORT_FILENAME).read_text()
+
+
+def test_quarantine_check_corrupt_moves_recording(tmp_path):
+    recording = tmp_path / 'videos' / 'title1' / 'date1'
+    recording.mkdir(parents=True)
+    (recording / '00001.ts').write_bytes(b'\x00' * 188)
+    quarantine_dir = tmp_path / 'quarantine'
+
+    assert not Quarantine(quarantine_dir).check(recording, ['00001.ts', 'info'])
+    assert not recording.exists()
+    assert (quarantine_dir / 'title1' / 'date1' / '00001.ts').exists()
+    assert (quarantine_dir / 'title1' / 'date1' / Quarantine.REPORT_FILENAME).exists()
+
+
+def test_quarantine_check_corrupt_existing_target(tmp_path):
+    recording = tmp_path / 'videos' / 'title1' / 'date1'
+    recording.mkdir(parents=True)
+    (recording / '00001.ts').write_bytes(b'\x00' * 188)
+    quarantine_dir = tmp_path / 'quarantine'
+    (quarantine_dir / 'title1' / 'date1').mkdir(parents=True)
+
+    assert not Quarantine(quarantine_dir).check(recording, ['00001.ts', 'info'])
+    assert not (quarantine_dir / 'title1' / 'date1' / 'date1').exists()
+    assert (quarantine_dir / 'title1' / 'date1.1' / '00001.ts').exists()
+
+
+def test_quarantine_check_continuity_errors_only(tmp_path):
+    (tmp_path / '00001.ts').write_bytes(ts_packet(0x100, 0) + ts_packet(0x100, 5))
+
+    assert Quarantine('quarantine').check(tmp_path, ['00001.ts', 'info'])
+
+
+def test_ts_scanner_scan(tmp_path):
+    path = tmp_path / '00001.ts'
+    path.write_bytes(b''.join(ts_packet(0x100, counter % 16) for counter in range(40)) +
+                     ts_packet(0x1fff, 5) + ts_packet(0x101, 7))
+
+    report = TsScanner.scan(path)
+
+    assert 42 == report.packets
+    assert 0 == report.sync_errors
+    assert {} == report.continuity_errors
+    assert 0 == report.trailing_bytes
+    assert report.is_ok()
+
+
+def test_ts_scanner_scan_empty_file(tmp_path):
+    path = tmp_path / '00001.ts'
+    path.write_bytes(b'')
+
+    report = TsScanner.scan(path)
+
+    assert 0 == report.packets
+    assert not report.is_ok()
+
+
+def test_ts_scanner_scan_error_is_not_hidden(mocker, tmp_path):
+    path = tmp_path / '00001.ts'
+    path.write_bytes(ts_packet(0x100, 0))
+    mocker.patch('vdr_to_hts_import.TsScanner._count_continuity_errors', side_effect=RuntimeError('scan failed'))
+
+    with pytest.raises(RuntimeError) as exc_info:
+        TsScanner.scan(path)
+    assert 'scan failed' == str(exc_info.value)
+
+
+def test_ts_scanner_scan_sync_errors_and_truncation(tmp_path):
+    path = tmp_path / '00001.ts'
+    path.write_bytes(ts_packet(0x100, 0) + b'\x00' * 188 + ts_packet(0x100, 1) + ts_packet(0x100, 2)[:50])
+
+    report = TsScanner.scan(path)
+
+    assert 3 == report.packets
+    assert 1 == report.sync_errors
+    assert {} == report.continuity_errors
+    assert 50 == report.trailing_bytes
+    assert not report.is_ok()
+
+
+def test_ts_scanner_scan_continuity_errors():
+    buffer = (ts_packet(0x100, 14) + ts_packet(0x101, 3) + ts_packet(0x100, 15) + ts_packet(0x100, 0) +
+              # duplicate packet
+              ts_packet(0x100, 0) +
+              # adaptation field only, counter does not increment
+              ts_packet(0x100, 0, payload=False) +
+              # lost packets on both PIDs
+              ts_packet(0x100, 3) + ts_packet(0x101, 9) +
+              # signalled discontinuity
+              ts_packet(0x101, 2, discontinuity=True) + ts_packet(0x101, 3))
+
+    report = TsScanner.scan_buffer('buffer', buffer)
+
+    assert 10 == report.packets
+    assert {0x100: 1, 0x101: 1} == report.continuity_errors
+    assert 'PID 0x0100: 1 continuity errors' in str(report)
+    assert report.is_ok()
+
+
+def test_recording_estimate_cost(tmp_path):
+    (tmp_path / '00001.ts').write_bytes(b'\x00' * 100)
+    (tmp_path / '00002.ts').write_bytes(b'\x00' * 50)
+
+    assert 300 == Recording(tmp_path, ['00001.ts', '00002.ts', 'info']).estimate_cost()
+    assert 100 == Recording(tmp_path, ['00001.ts', 'info']).estimate_cost()
+
+
+def test_scheduler_unknown_order():
+    with pytest.raises(ValueError):
+        Scheduler('largest')
+
+
+def test_scheduler_run_cheapest(mocker):
+    recordings = [Recording(Path('a'), []), Recording(Path('b'), []), Recording(Path('c'), [])]
+    mocker.patch.object(recordings[0], 'estimate_cost', return_value=300)
+    mocker.patch.object(recordings[1], 'estimate_cost', return_value=0)
+    mocker.patch.object(recordings[2], 'estimate_cost', return_value=100)
+    process = Mock()
+
+    Scheduler('cheapest').run('top', recordings, process)
+
+    process.assert_has_calls([mocker.call(recordings[1]), mocker.call(recordings[2]), mocker.call(recordings[0])])
+
+
+def test_scheduler_run_oldest(tmp_path):
+    recordings = []
+    for name, info in [('a', 'E 1 300 60 4E\n'), ('b', 'T no event\n'), ('c', 'E 1 100 60 4E\n')]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'info').write_text(info)
+        recordings.append(Recording(tmp_path / name, ['info']))
+    process = Mock()
+
+    Scheduler('oldest').run('top', recordings, process)
+
+    assert [recordings[2], recordings[0], recordings[1]] == [call.args[0] for call in process.call_args_list]
+
+
+def test_scheduler_run_priority(tmp_path):
+    recordings = []
+    for name, info in [('a', 'P 50\n'), ('b', 'T no priority\n'), ('c', 'P 99\n')]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'info').write_text(info)
+        recordings.append(Recording(tmp_path / name, ['info']))
+    process = Mock()
+
+    Scheduler('priority').run('top', recordings, process)
+
+    assert [recordings[2], recordings[0], recordings[1]] == [call.args[0] for call in process.call_args_list]
+
+
+def test_scheduler_run_time_budget_writes_checkpoint(mocker, tmp_path):
+    mocker.patch('time.monotonic', side_effect=[1000, 1000, 1000, 1050, 1050, 1050, 1100, 1100])
+    recordings = [Recording(Path('a'), []), Recording(Path('b'), []), Recording(Path('c'), [])]
+    checkpoint_path = tmp_path / 'checkpoint'
+    process = Mock()
+
+    scheduler = Scheduler(time_budget=100, checkpoint_path=checkpoint_path)
+    scheduler.run('top', recordings, process)
+
+    process.assert_has_calls([mocker.call(recordings[0]), mocker.call(recordings[1])])
+    assert 2 == process.call_count
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert [str(Path(name).resolve()) for name in ['a', 'b', 'c']] == checkpoint['known']
+    assert [str(Path('c').resolve())] == checkpoint['remaining']
+
+
+def test_scheduler_run_skips_recording_exceeding_time_budget(mocker, tmp_path):
+    mocker.patch('time.monotonic', return_value=1000)
+    recordings = [Recording(Path('a'), []), Recording(Path('b'), []), Recording(Path('c'), [])]
+    mocker.patch.object(recordings[0], 'estimate_cost', return_value=0)
+    mocker.patch.object(recordings[1], 'estimate_cost', return_value=200 * 1000 * 1000)
+    mocker.patch.object(recordings[2], 'estimate_cost', return_value=50 * 1000 * 1000)
+    checkpoint_path = tmp_path / 'checkpoint'
+    process = Mock()
+
+    scheduler = Scheduler(time_budget=100, checkpoint_path=checkpoint_path, throughput=1000 * 1000)
+    scheduler.run('top', recordings, process)
+
+    process.assert_has_calls([mocker.call(recordings[0]), mocker.call(recordings[2])])
+    assert 2 == process.call_count
+    assert [str(Path('b').resolve())] == json.loads(checkpoint_path.read_text())['remaining']
+
+
+def test_scheduler_run_measures_throughput(mocker):
+    mocker.patch('time.monotonic', side_effect=[1000, 1000, 1000, 1010])
+    recording = Recording(Path('a'), [])
+    mocker.patch.object(recording, 'estimate_cost', return_value=200)
+
+    scheduler = Scheduler(time_budget=100)
+    scheduler.run('top', [recording], Mock())
+
+    assert 20 == scheduler.throughput
+
+
+def test_scheduler_run_failure_continues(tmp_path):
+    recordings = [Recording(Path('a'), []), Recording(Path('b'), []), Recording(Path('c'), [])]
+    checkpoint_path = tmp_path / 'checkpoint'
+    process = Mock(side_effect=[None, InfoError('broken info'), None])
+
+    scheduler = Scheduler(checkpoint_path=checkpoint_path)
+    scheduler.run('top', recordings, process)
+
+    assert 3 == process.call_count
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert [] == checkpoint['remaining']
+    assert [str(Path('b').resolve())] == checkpoint['failed']
+
+    process.reset_mock()
+    scheduler.run('top', recordings, process)
+
+    process.assert_not_called()
+    assert [str(Path('b').resolve())] == json.loads(checkpoint_path.read_text())['failed']
+
+
+def test_scheduler_run_checkpoint_unreadable(tmp_path):
+    recordings = [Recording(Path('a'), [])]
+    checkpoint_path = tmp_path / 'checkpoint'
+    checkpoint_path.write_text('{"top_directory": "/v", "kno')
+    process = Mock()
+
+    Scheduler(checkpoint_path=checkpoint_path).run('top', recordings, process)
+
+    process.assert_called_once_with(recordings[0])
+    assert [] == json.loads(checkpoint_path.read_text())['remaining']
+    assert not Path(str(checkpoint_path) + '.tmp').exists()
+
+
 def test_importer_import_record(mocker):
     mocker.patch('keyring.get_password', return_value='pwd1')
     mocker.patch('vdr_to_hts_import.Config.create_from_info', return_value={
@@ -263,6 +600,32 @@ def test_info_get_duration_no_duration(mocker):
         assert 'no EPG event in info file test/info' == str(exc_info.value)
 
 
+def test_info_get_priority(mocker):
+    open_mock = mocker.mock_open(read_data='P 50\n')
+    info = Info(Path('test'))
+
+    with patch('builtins.open', open_mock):
+        assert 50 == info.get_priority()
+
+
+def test_info_get_priority_invalid_format(mocker):
+    open_mock = mocker.mock_open(read_data='P high\n')
+    info = Info(Path('test'))
+
+    with patch('builtins.open', open_mock):
+        with pytest.raises(InfoError) as exc_info:
+            info.get_priority()
+        assert 'priority is wrong format in info file test/info' == str(exc_info.value)
+
+
+def test_info_get_priority_no_priority(mocker):
+    open_mock = mocker.mock_open(read_data='Y no priority\n')
+    info = Info(Path('test'))
+
+    with patch('builtins.open', open_mock):
+        assert info.get_priority() is None
+
+
 def test_info_get_subtitle(mocker):
     open_mock = mocker.mock_open(read_data='S subtitle1\n')
     info = Info(Path('test'))
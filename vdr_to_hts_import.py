@@ -19,10 +19,13 @@ import argparse
 import json
 import logging
 import os
+import shutil
 import subprocess
+import time
 from pathlib import Path
 
 import keyring
+import numpy as np
 import requests
 from requests.auth import HTTPDigestAuth
 
@@ -99,6 +102,19 @@ class Info:
 
         return duration
 
+    def get_priority(self):
+        """
+        Return the priority of the recording or None if the info file has none
+        """
+        priority = self._get('P')
+        if priority is None:
+            return None
+
+        try:
+            return int(priority)
+        except ValueError:
+            raise InfoError('priority is wrong format in info file ' + str(self.filepath))
+
     def get_subtitle(self):
         """
         Return the subtitle of the show
@@ -228,6 +244,140 @@ class Config:
         return filename
 
 
+class TsScanReport:
+    """
+    Result of scanning one MPEG transport stream file
+    """
+    def __init__(self, path, packets, sync_errors, continuity_errors, trailing_bytes):
+        self.path = path
+        self.packets = packets
+        self.sync_errors = sync_errors
+        self.continuity_errors = continuity_errors
+        self.trailing_bytes = trailing_bytes
+
+    def is_ok(self):
+        """
+        Continuity errors are only reported. A few of them are common after reception glitches and neither ffmpeg nor
+        Tvheadend has a problem with them.
+        """
+        return self.packets > 0 and self.sync_errors == 0 and self.trailing_bytes == 0
+
+    def __str__(self):
+        lines = ['{}: {} packets, {} sync errors, {} trailing bytes'.format(
+            self.path, self.packets, self.sync_errors, self.trailing_bytes)]
+        for pid, errors in sorted(self.continuity_errors.items()):
+            lines.append('  PID 0x{:04x}: {} continuity errors'.format(pid, errors))
+        return '\n'.join(lines)
+
+
+class TsScanner:
+    """
+    Check the integrity of MPEG transport stream files without decoding them. The file is memory mapped and viewed as a
+    two-dimensional array of 188 byte packets so that all checks run in NumPy instead of a Python loop over packets.
+    """
+    PACKET_SIZE = 188
+    SYNC_BYTE = 0x47
+    # 4 byte packet header plus adaptation field length and flags
+    HEADER_SIZE = 6
+    NULL_PID = 0x1fff
+
+    @staticmethod
+    def scan(path):
+        if os.path.getsize(path) == 0:
+            return TsScanReport(path, 0, 0, {}, 0)
+        # np.memmap unmaps the file when the last view into it is gone. An explicitly closed mmap would fail with
+        # BufferError while a traceback still references the views and hide the actual error.
+        return TsScanner.scan_buffer(path, np.memmap(path, dtype=np.uint8, mode='r'))
+
+    @staticmethod
+    def scan_buffer(path, buffer):
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        number_of_packets, trailing_bytes = divmod(len(data), TsScanner.PACKET_SIZE)
+        packets = data[:number_of_packets * TsScanner.PACKET_SIZE].reshape(number_of_packets, TsScanner.PACKET_SIZE)
+
+        # Only the header columns are copied when masking, never the whole packets
+        headers = packets[:, :TsScanner.HEADER_SIZE]
+        in_sync = headers[:, 0] == TsScanner.SYNC_BYTE
+        sync_errors = int(number_of_packets - np.count_nonzero(in_sync))
+
+        return TsScanReport(path, number_of_packets, sync_errors,
+                            TsScanner._count_continuity_errors(headers[in_sync]), trailing_bytes)
+
+    @staticmethod
+    def _count_continuity_errors(headers):
+        """
+        Count continuity errors per PID in the packet headers including the first two adaptation field bytes.
+        The continuity counter of a PID increments by one (modulo 16) with every packet that carries a payload. A
+        repeated counter is a permitted duplicate packet, and the discontinuity indicator in the adaptation field
+        allows the counter to jump.
+        """
+        pids = (headers[:, 1].astype(np.uint16) & 0x1f) << 8 | headers[:, 2]
+        adaptation_field_control = headers[:, 3] >> 4 & 0x3
+        has_payload = (adaptation_field_control & 0x1) != 0
+        discontinuity = ((adaptation_field_control & 0x2) != 0) & (headers[:, 4] > 0) & ((headers[:, 5] & 0x80) != 0)
+
+        counted = has_payload & (pids != TsScanner.NULL_PID)
+        pids = pids[counted]
+        counters = headers[counted, 3] & 0x0f
+        discontinuity = discontinuity[counted]
+
+        # A stable sort groups the packets by PID while keeping their order within each PID
+        order = np.argsort(pids, kind='stable')
+        pids = pids[order]
+        counters = counters[order]
+        discontinuity = discontinuity[order]
+
+        step = (counters[1:] - counters[:-1]) & 0x0f
+        errors = (pids[1:] == pids[:-1]) & (step > 1) & ~discontinuity[1:]
+
+        error_pids, error_counts = np.unique(pids[1:][errors], return_counts=True)
+        return {int(pid): int(count) for pid, count in zip(error_pids, error_counts)}
+
+
+class Quarantine:
+    """
+    Scan the .ts files of a recording before anything is copied or imported. Broken recordings get a report file and
+    are moved into the quarantine directory, if one is given.
+    """
+    REPORT_FILENAME = 'ts-scan-report.txt'
+
+    def __init__(self, quarantine_dir=None):
+        self.quarantine_dir = quarantine_dir
+
+    def check(self, directory, files):
+        """
+        Return True if all .ts files of the recording are intact
+        """
+        reports = [TsScanner.scan(directory / file) for file in sorted(files) if '.ts' == file[-3:]]
+        if all(report.is_ok() for report in reports):
+            return True
+
+        report_text = '\n'.join(str(report) for report in reports)
+        logging.error("corrupt transport stream in {}:\n{}".format(directory, report_text))
+        with open(str(directory / Quarantine.REPORT_FILENAME), 'w') as report_file:
+            report_file.write(report_text + '\n')
+
+        if self.quarantine_dir is not None:
+            # Keep the recording title / recording date structure of the VDR directory tree
+            target = Quarantine._unique_target(Path(self.quarantine_dir, directory.parent.name, directory.name))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(directory), str(target))
+            logging.error("moved {} to {}".format(directory, target))
+        return False
+
+    @staticmethod
+    def _unique_target(target):
+        """
+        shutil.move would move the directory into an existing target, so append a number to the name instead
+        """
+        unique_target = target
+        number = 1
+        while unique_target.exists():
+            unique_target = target.with_name('{}.{}'.format(target.name, number))
+            number += 1
+        return unique_target
+
+
 class Importer:
     """
     Read a VDR directory and import the files into Tvheadend
@@ -255,20 +405,203 @@ class Importer:
         logging.info("server response:\n{}".format(response.text))
 
 
+class Recording:
+    """
+    A VDR recording directory that was found by the DirWalker
+    """
+    def __init__(self, directory, files):
+        self.directory = directory
+        self.files = files
+        self.cost = None
+
+    def estimate_cost(self):
+        """
+        Return the number of bytes that need to be processed for the import. All .ts files are read once by the
+        integrity scan and a recording with several .ts files is read a second time to concatenate them. The POST
+        request to Tvheadend is negligible.
+        """
+        if self.cost is None:
+            ts_files = [file for file in self.files if '.ts' == file[-3:]]
+            ts_bytes = sum((self.directory / file).stat().st_size for file in ts_files)
+            self.cost = ts_bytes if len(ts_files) < 2 else 2 * ts_bytes
+        return self.cost
+
+
+class Scheduler:
+    """
+    Run the import of recordings in a given order within a time budget. A recording is only started if its estimated
+    duration fits into the remaining budget. The checkpoint file is rewritten before each recording and records all
+    recordings that are known, that are left for the next run and whose import failed. A recording is imported only
+    once, even across runs.
+    """
+    ORDERS = ['cheapest', 'oldest', 'priority']
+
+    def __init__(self, order=None, time_budget=None, checkpoint_path=None, throughput=50 * 1000 * 1000):
+        if order is not None and order not in Scheduler.ORDERS:
+            raise ValueError('unknown order ' + order)
+        self.order = order
+        self.time_budget = time_budget
+        self.checkpoint_path = checkpoint_path
+        # bytes per second, replaced by the measured throughput once a recording has finished
+        self.throughput = throughput
+        self.bytes_done = 0
+        self.seconds_done = 0
+
+    def run(self, top_directory, recordings, process):
+        """
+        Call process for each recording in schedule order. If the previous run for the same top directory left a
+        checkpoint, only its remaining recordings and recordings that were added since then are processed.
+        """
+        known = [self._key(recording.directory) for recording in recordings]
+        remaining, failed = self._resume(top_directory, recordings)
+        remaining = self._sort(remaining)
+        deadline = None if self.time_budget is None else time.monotonic() + self.time_budget
+
+        for recording in list(remaining):
+            self._save_checkpoint(top_directory, known, remaining, failed)
+            if deadline is not None:
+                seconds_left = deadline - time.monotonic()
+                if seconds_left <= 0:
+                    break
+                if self._estimate_seconds(recording) > seconds_left:
+                    logging.info("skipping {}, estimated {:.0f} seconds exceed remaining time budget".format(
+                        recording.directory, self._estimate_seconds(recording)))
+                    continue
+
+            start = time.monotonic()
+            try:
+                process(recording)
+            except Exception as exc:
+                logging.error('Failed to import recording ' + str(recording.directory), exc_info=exc)
+                failed.append(self._key(recording.directory))
+            else:
+                if deadline is not None:
+                    self._measure(recording, time.monotonic() - start)
+            remaining.remove(recording)
+
+        if remaining:
+            logging.info("time budget used up, {} recordings left".format(len(remaining)))
+        self._save_checkpoint(top_directory, known, remaining, failed)
+
+    def _estimate_seconds(self, recording):
+        return recording.estimate_cost() / self.throughput
+
+    def _measure(self, recording, seconds):
+        cost = recording.estimate_cost()
+        if cost > 0 and seconds > 0:
+            self.bytes_done += cost
+            self.seconds_done += seconds
+            self.throughput = self.bytes_done / self.seconds_done
+
+    def _resume(self, top_directory, recordings):
+        """
+        Return the recordings to process and the recordings that failed in earlier runs
+        """
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None:
+            return list(recordings), []
+        if checkpoint['top_directory'] != self._key(top_directory):
+            logging.warning("ignoring checkpoint {} for different top directory {}".format(
+                self.checkpoint_path, checkpoint['top_directory']))
+            return list(recordings), []
+
+        known = set(checkpoint['known'])
+        remaining = set(checkpoint['remaining'])
+        return [recording for recording in recordings
+                if self._key(recording.directory) in remaining or self._key(recording.directory) not in known], \
+            checkpoint['failed']
+
+    def _load_checkpoint(self):
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return None
+
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if not isinstance(checkpoint, dict) or \
+                    not all(key in checkpoint for key in ['top_directory', 'known', 'remaining', 'failed']):
+                raise ValueError('missing entries')
+        except (OSError, ValueError) as exc:
+            logging.warning("ignoring unreadable checkpoint {}: {}".format(self.checkpoint_path, exc))
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, top_directory, known, remaining, failed):
+        """
+        Write to a temporary file first, so a run that is killed while writing does not leave a truncated checkpoint
+        """
+        if self.checkpoint_path is None:
+            return
+        checkpoint = {
+            'top_directory': self._key(top_directory),
+            'known': known,
+            'remaining': [self._key(recording.directory) for recording in remaining],
+            'failed': failed
+        }
+        temporary_path = str(self.checkpoint_path) + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=4)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    @staticmethod
+    def _key(directory):
+        """
+        The checkpoint stores absolute paths, so it is independent of the working directory
+        """
+        return str(Path(directory).resolve())
+
+    def _sort(self, recordings):
+        if self.order == 'cheapest':
+            return sorted(recordings, key=lambda recording: recording.estimate_cost())
+        elif self.order == 'oldest':
+            return sorted(recordings, key=lambda recording: self._info_key(recording, Info.get_start_date_time))
+        elif self.order == 'priority':
+            # VDR priorities go from 0 to 99 with 99 being the most important
+            return sorted(recordings, key=lambda recording: self._info_key(recording, Info.get_priority, -1))
+        return list(recordings)
+
+    @staticmethod
+    def _info_key(recording, getter, sign=1):
+        """
+        Recordings with a missing or broken info value are sorted last
+        """
+        try:
+            value = getter(Info(recording.directory))
+        except InfoError as exc:
+            logging.warning(str(exc))
+            value = None
+        return float('inf') if value is None else sign * value
+
+
 class DirWalker:
-    def __init__(self, user):
+    def __init__(self, user, quarantine_dir=None, scheduler=None):
         self.importer = Importer(user)
+        self.quarantine = Quarantine(quarantine_dir)
+        self.scheduler = Scheduler() if scheduler is None else scheduler
 
     def walk(self, top_directory):
+        """
+        Import all recordings below the top directory
+        """
+        self.scheduler.run(top_directory, self.find_recordings(top_directory), self._import_recording)
+
+    @staticmethod
+    def find_recordings(top_directory):
         """
         Walk through a directory tree with this structure:
         / top directory / recording title / recording date / recording files
         """
+        recordings = []
         for recording_dir in Path(top_directory).iterdir():
             if recording_dir.is_dir():
                 for root, _, files in os.walk(recording_dir):
                     if 'info' in files:
-                        self.importer.import_record(Path(root), files)
+                        recordings.append(Recording(Path(root), files))
+        return recordings
+
+    def _import_recording(self, recording):
+        if self.quarantine.check(recording.directory, recording.files):
+            self.importer.import_record(recording.directory, recording.files)
 
 
 def main():
@@ -277,9 +610,20 @@ def main():
     parser = argparse.ArgumentParser(description='Import VDR recordings into HTS Tvheadend.')
     parser.add_argument('-d', '--dir', default='/v', help='top directory to scan for VDR recordings')
     parser.add_argument('-u', '--user', required=True, help='user to authenticate with Tvheadend')
+    parser.add_argument('-q', '--quarantine-dir',
+                        help='move recordings with corrupt .ts files into this directory instead of importing them')
+    parser.add_argument('-o', '--order', choices=Scheduler.ORDERS,
+                        help='import order of the recordings (default: directory order)')
+    parser.add_argument('-t', '--time-budget', type=int,
+                        help='only start imports that are expected to finish within this many seconds')
+    parser.add_argument('--throughput', type=float, default=50,
+                        help='initial estimate in MB/s for checking and concatenating .ts files (default: 50)')
+    parser.add_argument('-c', '--checkpoint', default='vdr_to_hts_import.checkpoint',
+                        help='file that records the recordings left for the next run')
     args = parser.parse_args()
 
-    walker = DirWalker(args.user)
+    scheduler = Scheduler(args.order, args.time_budget, args.checkpoint, args.throughput * 1000 * 1000)
+    walker = DirWalker(args.user, args.quarantine_dir, scheduler)
     walker.walk(args.dir)
 
 